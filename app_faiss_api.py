@@ -1,12 +1,19 @@
-import json
+import hashlib
+import orjson
+import queue
+import threading
+import time
 import faiss
 import numpy as np
+import torch
 import google.generativeai as genai
 from dotenv import load_dotenv
 import os
+from concurrent.futures import Future
 from functools import lru_cache
 
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
 from werkzeug.middleware.proxy_fix import ProxyFix
 from sentence_transformers import SentenceTransformer
@@ -17,18 +24,64 @@ API_KEY = os.getenv("GEMINI_API_KEY")
 
 if not API_KEY:
     print("⚠️  GEMINI_API_KEY no está definido en las variables de entorno")
-genai.configure(api_key=API_KEY)
+# Transporte REST: a diferencia del canal gRPC, pasa por sockets que gevent
+# parchea, así la espera por Gemini cede el worker en vez de bloquearlo.
+genai.configure(api_key=API_KEY, transport="rest")
+
+# Preámbulo fijo: va como system_instruction, no se rearma en cada prompt
+PROMPT_PREAMBULO = (
+    "Usá el siguiente contexto para responder la pregunta del usuario, si no encuentras la respuesta intenta responderla tú, "
+    "ten en cuenta que somos una empresa de TI que soluciona problemas a la industria y al agro."
+)
+
+# Modelo de Gemini instanciado una sola vez (evita reconstruirlo por request)
+GEMINI_MODEL = genai.GenerativeModel("gemini-2.5-flash", system_instruction=PROMPT_PREAMBULO)
 
 INDEX_FILE = "vector_index.faiss"
 METADATA_FILE = "metadata.json"
 
 # === MODELO DE EMBEDDINGS LOCAL ===
-print("⏳ Cargando modelo de embeddings local (all-MiniLM-L6-v2)...")
-embedding_model = SentenceTransformer("all-MiniLM-L6-v2")
-print("✅ Modelo de embeddings cargado")
+EMBEDDING_DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+
+_modelo_lock = threading.Lock()
+_modelo_pid = None
+
+if EMBEDDING_DEVICE == "cpu":
+    # En CPU se carga al importar: con --preload los pesos quedan compartidos
+    # copy-on-write entre los workers forkeados
+    print("⏳ Cargando modelo de embeddings local (all-MiniLM-L6-v2) en cpu...")
+    embedding_model = SentenceTransformer("all-MiniLM-L6-v2", device="cpu")
+    print("✅ Modelo de embeddings cargado")
+else:
+    # En CUDA recién al primer uso en cada worker: un contexto de CUDA creado
+    # en el master no se puede reusar después del fork()
+    embedding_model = None
+
+def obtener_modelo_embeddings():
+    global embedding_model, _modelo_pid
+    if EMBEDDING_DEVICE == "cpu":
+        return embedding_model
+    if _modelo_pid != os.getpid():
+        with _modelo_lock:
+            if _modelo_pid != os.getpid():
+                print(f"⏳ Cargando modelo de embeddings local (all-MiniLM-L6-v2) en cuda (pid {os.getpid()})...")
+                embedding_model = SentenceTransformer("all-MiniLM-L6-v2", device="cuda")
+                _modelo_pid = os.getpid()
+                print("✅ Modelo de embeddings cargado")
+    return embedding_model
 
 # === APP FLASK ===
+class OrJSONProvider(JSONProvider):
+    """JSON de Flask con orjson (parser/serializador en C, varias veces más rápido)"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = OrJSONProvider(app)
 app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
 
 CORS(
@@ -43,10 +96,19 @@ def cargar_index_y_metadata():
     if not os.path.exists(INDEX_FILE) or not os.path.exists(METADATA_FILE):
         raise FileNotFoundError("❌ No se encontraron los archivos FAISS o metadata.json")
     
-    index = faiss.read_index(INDEX_FILE)
-    
-    with open(METADATA_FILE, "r", encoding="utf-8") as f:
-        metadata = json.load(f)
+    # mmap: los workers de gunicorn comparten una sola copia en el page cache
+    try:
+        index = faiss.read_index(INDEX_FILE, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+    except RuntimeError:
+        # No todos los tipos de índice soportan mmap; caemos a la carga en RAM
+        index = faiss.read_index(INDEX_FILE)
+
+    # Si el índice es HNSW (ver build_index.py) ajustamos la profundidad de búsqueda
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = 64
+
+    with open(METADATA_FILE, "rb") as f:
+        metadata = orjson.loads(f.read())
         # Aseguramos que es lista de diccionarios
         if not isinstance(metadata, list):
             raise ValueError("❌ metadata.json debe ser una lista de diccionarios")
@@ -56,44 +118,222 @@ def cargar_index_y_metadata():
 # Cargamos FAISS y metadata una sola vez al inicio
 try:
     index, metadata = cargar_index_y_metadata()
+    # SoA: dos arrays paralelos en vez de la lista de dicts; el lookup por
+    # índice queda en un solo salto de puntero con layout contiguo
+    DOCUMENTOS = np.array([doc["file"] for doc in metadata], dtype=object)
+    TEXTOS = np.array([doc["text"] for doc in metadata], dtype=object)
     print("✅ Índice FAISS y metadata cargados en memoria")
 except Exception as e:
     print(f"⚠️ Error cargando FAISS: {e}")
-    index, metadata = None, None
+    index, DOCUMENTOS, TEXTOS = None, None, None
+
+# === MICRO-BATCHING ===
+# Bajo carga concurrente conviene un solo encode()/search() por lote en vez de
+# uno por request: SentenceTransformer y FAISS aprovechan el batch casi lineal.
+BATCH_MAX = 32
+BATCH_ESPERA = 0.01  # segundos que el worker espera para completar el lote
+BATCH_TIMEOUT = 30   # segundos máximos esperando el resultado de un lote
+TOP_K = 3
+
+def _ejecutar_en_hilo_real(funcion, *args):
+    """Corre la función en un hilo nativo del SO cuando gevent está parcheado.
+
+    Con monkey-patching el worker del batcher es un greenlet, y el encode
+    (CPU-bound) bloquearía el event loop entero por cada lote. El threadpool
+    del hub es el mecanismo de gevent para cruzar a un hilo real y esperar
+    cooperativamente; torch suelta el GIL durante el matmul, así el loop
+    sigue atendiendo requests mientras se encodea.
+    """
+    try:
+        from gevent import monkey
+        if monkey.is_module_patched("threading"):
+            import gevent
+            return gevent.get_hub().threadpool.apply(funcion, args)
+    except ImportError:
+        pass
+    return funcion(*args)
+
+class MicroBatcher:
+    """Junta pedidos concurrentes y los resuelve con una sola llamada por lote"""
+
+    def __init__(self, nombre, funcion_lote):
+        self.nombre = nombre
+        self.funcion_lote = funcion_lote
+        self.cola = queue.Queue()
+        # El hilo se arranca recién en el primer procesar(): con gunicorn
+        # --preload el import corre en el master y los hilos no sobreviven
+        # al fork(), así que cada worker tiene que levantar el suyo.
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _asegurar_worker(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                hilo = threading.Thread(target=self._worker, name=self.nombre, daemon=True)
+                hilo.start()
+                self._pid = os.getpid()
+
+    def procesar(self, item):
+        self._asegurar_worker()
+        futuro = Future()
+        self.cola.put((item, futuro))
+        # Con timeout: si el hilo murió preferimos un 500 a colgar el request
+        return futuro.result(timeout=BATCH_TIMEOUT)
+
+    def _worker(self):
+        while True:
+            lote = [self.cola.get()]
+            plazo = time.monotonic() + BATCH_ESPERA
+            while len(lote) < BATCH_MAX:
+                restante = plazo - time.monotonic()
+                if restante <= 0:
+                    break
+                try:
+                    lote.append(self.cola.get(timeout=restante))
+                except queue.Empty:
+                    break
+
+            try:
+                resultados = _ejecutar_en_hilo_real(self.funcion_lote, [item for item, _ in lote])
+                for (_, futuro), resultado in zip(lote, resultados):
+                    futuro.set_result(resultado)
+            except Exception as e:
+                for _, futuro in lote:
+                    futuro.set_exception(e)
+
+def _encode_lote(textos):
+    vectores = obtener_modelo_embeddings().encode(list(textos), batch_size=BATCH_MAX, convert_to_numpy=True)
+    return [np.array(v, dtype=np.float32) for v in vectores]
+
+def _search_lote(vectores):
+    D, I = index.search(np.stack(vectores), k=TOP_K)
+    return list(I)
+
+embedding_batcher = MicroBatcher("embedding-batcher", _encode_lote)
+search_batcher = MicroBatcher("search-batcher", _search_lote)
+
+# === CACHE SEMÁNTICO DE RESPUESTAS ===
+# Preguntas casi iguales ("¿qué hacen?", "que hacen ustedes?") devuelven la
+# respuesta ya generada si la similitud coseno supera el umbral.
+CACHE_UMBRAL = 0.92
+CACHE_MAX = 2000
+
+cache_index = None      # faiss.IndexFlatIP con los embeddings normalizados
+cache_vectores = []     # vectores normalizados (para reconstruir al depurar)
+cache_respuestas = []   # respuestas en paralelo al índice
+
+def _normalizar(vector):
+    # ascontiguousarray no copia si el vector ya es float32 contiguo
+    v = np.ascontiguousarray(vector, dtype=np.float32).reshape(1, -1)
+    faiss.normalize_L2(v)
+    return v
+
+def buscar_en_cache(vector_consulta):
+    """Devuelve la respuesta cacheada si hay una pregunta suficientemente parecida"""
+    if cache_index is None or cache_index.ntotal == 0:
+        return None
+
+    D, I = cache_index.search(_normalizar(vector_consulta), 1)
+    if D[0][0] >= CACHE_UMBRAL:
+        print(f"⚡ Cache semántico: hit con similitud {D[0][0]:.3f}")
+        return cache_respuestas[I[0][0]]
+    return None
+
+def guardar_en_cache(vector_consulta, respuesta):
+    global cache_index
+
+    vector = _normalizar(vector_consulta)
+    if cache_index is None:
+        cache_index = faiss.IndexFlatIP(vector.shape[1])
+
+    # Depuración FIFO: al llegar al tope descartamos la mitad más vieja
+    if len(cache_respuestas) >= CACHE_MAX:
+        mitad = CACHE_MAX // 2
+        del cache_vectores[:mitad]
+        del cache_respuestas[:mitad]
+        cache_index = faiss.IndexFlatIP(vector.shape[1])
+        cache_index.add(np.vstack(cache_vectores))
+
+    cache_index.add(vector)
+    cache_vectores.append(vector)
+    cache_respuestas.append(respuesta)
+
+# === CACHE DE EMBEDDINGS COMPARTIDO ===
+# lru_cache vive por proceso: con N workers cada uno arranca frío y los hits se
+# reparten. Si hay REDIS_URL definido, todos los workers comparten el cache.
+REDIS_URL = os.getenv("REDIS_URL")
+EMBEDDING_TTL = 3600  # segundos de vida de cada embedding en Redis
+
+redis_client = None
+if REDIS_URL:
+    try:
+        import redis
+        redis_client = redis.from_url(REDIS_URL)
+        redis_client.ping()
+        print("✅ Cache de embeddings compartido en Redis")
+    except Exception as e:
+        print(f"⚠️ Redis no disponible, uso cache local por worker: {e}")
+        redis_client = None
+
+def _calcular_embedding(texto):
+    print("📩 Texto a embebear (local):", texto[:200])  # primeros 200 chars
+    vector = embedding_batcher.procesar(texto)
+    # El índice se construye con vectores normalizados (ver build_index.py)
+    faiss.normalize_L2(vector.reshape(1, -1))
+    return vector
+
+def _embedding_con_redis(texto):
+    clave = b"emb:" + hashlib.sha256(texto.encode("utf-8")).digest()
+    cacheado = redis_client.get(clave)
+    if cacheado is not None:
+        return np.frombuffer(cacheado, dtype=np.float32).copy()
+
+    vector = _calcular_embedding(texto)
+    redis_client.setex(clave, EMBEDDING_TTL, vector.tobytes())
+    return vector
 
 @lru_cache(maxsize=5000)
+def _embedding_con_lru(texto):
+    return _calcular_embedding(texto)
+
 def obtener_embedding_local(texto: str):
     """Devuelve el embedding usando SentenceTransformer con cache"""
-    print("📩 Texto a embebear (local):", texto[:200])  # primeros 200 chars
-    vector = embedding_model.encode([texto], convert_to_numpy=True)[0]
-    return np.array(vector, dtype=np.float32)
+    if redis_client is not None:
+        try:
+            return _embedding_con_redis(texto)
+        except Exception as e:
+            print(f"⚠️ Error consultando Redis, calculo local: {e}")
+    return _embedding_con_lru(texto)
 
-def buscar_contexto_para_gemini(consulta, top_k=3):
-    if index is None or metadata is None:
+def buscar_contexto_para_gemini(vector_consulta, top_k=TOP_K):
+    if index is None or TEXTOS is None:
         raise RuntimeError("⚠️ El índice FAISS no está disponible en memoria")
 
-    vector_consulta = obtener_embedding_local(consulta)
-    D, I = index.search(np.array([vector_consulta]), k=top_k)
-
-    contexto = ""
-    for idx in I[0]:
-        doc = metadata[idx]
-        contexto += f"Documento: {doc['file']}\nTexto: {doc['text']}\n\n"
-    return contexto
+    if top_k == TOP_K:
+        indices = search_batcher.procesar(vector_consulta)
+    else:
+        # reshape devuelve una vista (1, d): no copia el vector por consulta
+        D, I = index.search(vector_consulta.reshape(1, -1), k=top_k)
+        indices = I[0]
 
-def responder_con_gemini(pregunta, contexto):
-    modelo = genai.GenerativeModel("gemini-2.5-flash")
-    prompt = f"""
-Usá el siguiente contexto para responder la pregunta del usuario, si no encuentras la respuesta intenta responderla tú,
-ten en cuenta que somos una empresa de TI que soluciona problemas a la industria y al agro.
+    partes = []
+    for idx in indices:
+        partes.append(f"Documento: {DOCUMENTOS[idx]}\nTexto: {TEXTOS[idx]}\n\n")
+    return "".join(partes)
 
+def armar_prompt(pregunta, contexto):
+    return f"""
 Contexto:
 {contexto}
 
 Pregunta:
 {pregunta}
 """
-    respuesta = modelo.generate_content(prompt)
+
+def responder_con_gemini(pregunta, contexto):
+    respuesta = GEMINI_MODEL.generate_content(armar_prompt(pregunta, contexto))
 
     # Manejo robusto de salida
     if hasattr(respuesta, "text"):
@@ -103,6 +343,32 @@ Pregunta:
     else:
         raise ValueError(f"❌ No se pudo interpretar la respuesta de Gemini: {respuesta}")
 
+def _evento_sse(texto):
+    # orjson escapa los saltos de línea, que romperían el framing de SSE
+    return f"data: {orjson.dumps({'texto': texto}).decode('utf-8')}\n\n"
+
+def responder_con_gemini_stream(pregunta, contexto, vector_consulta):
+    """Genera la respuesta en streaming (SSE) y la cachea completa al terminar"""
+    partes = []
+    try:
+        respuesta = GEMINI_MODEL.generate_content(armar_prompt(pregunta, contexto), stream=True)
+        for chunk in respuesta:
+            # chunk.text tira ValueError si el candidato vino bloqueado/vacío
+            texto = chunk.text
+            if texto:
+                partes.append(texto)
+                yield _evento_sse(texto)
+    except Exception as e:
+        # Los headers ya salieron: el error va por el stream y no cacheamos
+        print("❌ ERROR en streaming de Gemini:", e)
+        yield f"data: {orjson.dumps({'error': str(e)}).decode('utf-8')}\n\n"
+        yield "data: [DONE]\n\n"
+        return
+
+    if partes:
+        guardar_en_cache(vector_consulta, "".join(partes))
+    yield "data: [DONE]\n\n"
+
 # === ENDPOINT PRINCIPAL ===
 @app.route("/consultar", methods=["POST", "OPTIONS"])
 def consultar():
@@ -114,9 +380,29 @@ def consultar():
     if not pregunta:
         return jsonify({"error": "Falta el campo 'pregunta'"}), 400
 
+    # Con "stream": true la respuesta sale por SSE a medida que Gemini genera
+    stream = bool(data.get("stream"))
+
     try:
-        contexto = buscar_contexto_para_gemini(pregunta)
+        vector_consulta = obtener_embedding_local(pregunta)
+
+        respuesta_cacheada = buscar_en_cache(vector_consulta)
+        if respuesta_cacheada is not None:
+            if stream:
+                eventos = [_evento_sse(respuesta_cacheada), "data: [DONE]\n\n"]
+                return Response(eventos, mimetype="text/event-stream")
+            return jsonify({"respuesta": respuesta_cacheada})
+
+        contexto = buscar_contexto_para_gemini(vector_consulta)
+
+        if stream:
+            return Response(
+                responder_con_gemini_stream(pregunta, contexto, vector_consulta),
+                mimetype="text/event-stream"
+            )
+
         respuesta = responder_con_gemini(pregunta, contexto)
+        guardar_en_cache(vector_consulta, respuesta)
         return jsonify({"respuesta": respuesta})
     except Exception as e:
         print("❌ ERROR en /consultar:", e)  # Log visible en Railway
@@ -0,0 +1,60 @@
+"""Reconstruye vector_index.faiss a partir de los textos de metadata.json.
+
+Se corre offline (no en Railway) cada vez que cambian los documentos:
+
+    python build_index.py [--cuantizar fp16|int8]
+
+Con --cuantizar los vectores se guardan comprimidos (scalar quantizer):
+fp16 usa la mitad de RAM y int8 un cuarto, con pérdida de recall mínima.
+"""
+import argparse
+import json
+import faiss
+import numpy as np
+import torch
+from sentence_transformers import SentenceTransformer
+
+INDEX_FILE = "vector_index.faiss"
+METADATA_FILE = "metadata.json"
+
+CUANTIZADORES = {
+    "fp16": faiss.ScalarQuantizer.QT_fp16,
+    "int8": faiss.ScalarQuantizer.QT_8bit,
+}
+
+def construir_index(cuantizar=None):
+    with open(METADATA_FILE, "r", encoding="utf-8") as f:
+        metadata = json.load(f)
+
+    textos = [doc["text"] for doc in metadata]
+    print(f"⏳ Generando embeddings de {len(textos)} fragmentos...")
+    modelo = SentenceTransformer("all-MiniLM-L6-v2",
+                                 device="cuda" if torch.cuda.is_available() else "cpu")
+    vectores = modelo.encode(textos, convert_to_numpy=True).astype(np.float32)
+
+    # Normalizados, coseno == producto interno: una sola cadena de FMA por vector
+    faiss.normalize_L2(vectores)
+
+    d = vectores.shape[1]
+    # HNSW: búsqueda aproximada por grafo en vez del barrido exhaustivo del flat.
+    # Con este corpus chico el corpus entra igual, pero escala si crecen los docs.
+    if cuantizar:
+        # Variante con scalar quantizer: mismos enlaces HNSW, vectores comprimidos
+        index = faiss.IndexHNSWSQ(d, CUANTIZADORES[cuantizar], 32, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = 200
+        index.train(vectores)
+    else:
+        index = faiss.IndexHNSWFlat(d, 32, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = 200
+    index.add(vectores)
+
+    faiss.write_index(index, INDEX_FILE)
+    etiqueta = cuantizar or "fp32"
+    print(f"✅ Índice HNSW ({etiqueta}) guardado en {INDEX_FILE} ({index.ntotal} vectores, d={d})")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reconstruye el índice FAISS")
+    parser.add_argument("--cuantizar", choices=sorted(CUANTIZADORES), default=None,
+                        help="comprimir los vectores almacenados (fp16 o int8)")
+    args = parser.parse_args()
+    construir_index(args.cuantizar)
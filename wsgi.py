@@ -0,0 +1,12 @@
+"""Punto de entrada WSGI para gunicorn (ver Procfile).
+
+El monkey-patching de gevent tiene que correr antes de cualquier import que
+toque ssl/urllib3 (urllib3 captura SSLContext al importarse); con --preload
+esto pasa en el master, antes del fork y de importar la app.
+"""
+from gevent import monkey
+monkey.patch_all()
+
+from app_faiss_api import app
+
+__all__ = ["app"]